@@ -21,86 +21,145 @@ from __future__ import print_function
 import os
 import sys
 import json
+import string
 
-from texecomConnect import TexecomConnect
+from texecomConnect import TexecomConnect, log
 
 import paho.mqtt.client as paho
 
+try:
+    maketrans = str.maketrans
+except AttributeError:
+    # python 2
+    from string import maketrans
+
 broker_url = os.getenv('BROKER_URL','192.168.1.1')
 broker_port = os.getenv('BROKER_PORT',1883)
 broker_user = os.getenv('BROKER_USER',None)
 broker_pass = os.getenv('BROKER_PASS',None)
 
+# Also log the (large) discovery messages published for each zone/area
+log_mqtt_discovery = False
+
+# Home Assistant MQTT discovery topic prefixes
+BINARY_SENSOR_TOPIC = "homeassistant/binary_sensor/"
+ALARM_PANEL_TOPIC = "homeassistant/alarm_control_panel/"
+
+# Turns a zone/area name into a Home Assistant object id - lowercase with
+# spaces replaced by underscores - in a single pass
+HA_NAME_TABLE = maketrans(" " + string.ascii_uppercase, "_" + string.ascii_lowercase)
+
+# Reused compact encoder for discovery messages
+json_encode = json.JSONEncoder(separators=(",", ":")).encode
+
+# Home Assistant alarm_control_panel states, indexed by panel area state
+HA_AREA_STATES = ("disarmed", "pending", "pending", "armed_away", "armed_night", "triggered")
+
 def on_message(client, userdata, message):
-    time.sleep(1)
-    print("received message =",str(message.payload.decode("utf-8")))
+    # runs on paho's network thread, so keep it cheap and never block here
+    payload = message.payload.decode("utf-8")
+    log("received message = " + payload)
 
 client = paho.Client()
+# Reconnect to the broker quickly after a blip, backing off to 30 seconds
+client.reconnect_delay_set(min_delay=1, max_delay=30)
 
 client.username_pw_set(broker_user, broker_pass)
 client.on_message=on_message
 
-print("connecting to broker ", broker_url)
+log("connecting to broker " + broker_url)
 client.connect(broker_url, broker_port)
 client.loop_start()
 
 class TexecomConnectMqtt(TexecomConnect):
+    def __init__(self, host, port, udl_password, message_handler_func):
+        super(TexecomConnectMqtt, self).__init__(host, port, udl_password, message_handler_func)
+        # serialised 'device' block shared by every discovery message
+        self.deviceJson = None
+        # discovery messages queued up while enumerating the site data
+        self.pendingDiscovery = []
+
+    def discovery_json(self, message):
+        """Serialise a discovery message, splicing in the device block
+        which is only encoded once each time the site data is read"""
+        if self.deviceJson is None:
+            model = self.panelType + " " + str(self.numberOfZones)
+            self.deviceJson = json_encode({
+                "name": "Texecom " + model,
+                "identifiers": "123456789", #TODO panel serial number?
+                "manufacturer": "Texecom",
+                "model": model
+            })
+        return json_encode(message)[:-1] + ',"device":' + self.deviceJson + '}'
+
     # Overload get_zone_details to publish zone information to MQTT
     def get_zone_details(self, zone_number):
         zone = super(TexecomConnectMqtt, self).get_zone_details(zone_number)
-        if zone.zoneType != self.ZONETYPE_UNUSED:
+        if zone is not None and zone.zoneType != self.ZONETYPE_UNUSED:
             if zone.zoneType == 1:
                 HAZoneType = "door"
             elif zone.zoneType == 8:
                 HAZoneType = "safety"
             else:
                 HAZoneType = "motion"
-            name = str.lower((zone.text).replace(" ", "_"))
-            topicbase = str("homeassistant/binary_sensor/" + name)
-            configtopic = str(topicbase + "/config")
-            statetopic = str(topicbase + "/state")
+            name = zone.text.translate(HA_NAME_TABLE)
+            topicbase = BINARY_SENSOR_TOPIC + name
+            configtopic = topicbase + "/config"
+            statetopic = topicbase + "/state"
+            zone.state_topic = statetopic
             message = {
                 "name": name,
                 "device_class": HAZoneType,
                 "state_topic": statetopic,
                 "payload_on": "1",
                 "payload_off": "0",
-                "unique_id": ".".join([self.panelType, name]),
-                "device": {
-                    "name": "Texecom " + self.panelType + " " + str(self.numberOfZones),
-                    "identifiers": "123456789", #TODO panel serial number?
-                    "manufacturer": "Texecom",
-                    "model": self.panelType + " " + str(self.numberOfZones)
-                }
+                "unique_id": ".".join([self.panelType, name])
             }
-            # self.log(configtopic + ":" + json.dumps(message))
-            client.publish(configtopic,json.dumps(message), retain=True)
+            payload = self.discovery_json(message)
+            if log_mqtt_discovery:
+                self.log(configtopic + ":" + payload)
+            self.pendingDiscovery.append((configtopic, payload))
         return zone
 
     # Overload get_area_details to publish area information to MQTT
     def get_area_details(self, areaNumber):
         area = super(TexecomConnectMqtt, self).get_area_details(areaNumber)
-        name = str.lower((area.name).replace(" ", "_"))
-        topicbase = str("homeassistant/alarm_control_panel/" + name)
-        configtopic = str(topicbase + "/config")
-        statetopic = str(topicbase + "/state")
-        commandtopic = str(topicbase + "/command")
+        if area is None:
+            return None
+        name = area.name.translate(HA_NAME_TABLE)
+        topicbase = ALARM_PANEL_TOPIC + name
+        configtopic = topicbase + "/config"
+        statetopic = topicbase + "/state"
+        commandtopic = topicbase + "/command"
+        area.state_topic = statetopic
         message = {
             "name": name,
             "state_topic": statetopic,
             "command_topic": commandtopic,
-            "unique_id": ".".join([self.panelType, "area", name]),
-            "device": {
-                "name": "Texecom " + self.panelType + " " + str(self.numberOfZones),
-                "identifiers": "123456789", #TODO panel serial number?
-                "manufacturer": "Texecom",
-                "model": self.panelType + " " + str(self.numberOfZones)
-            }
+            "unique_id": ".".join([self.panelType, "area", name])
         }
-        # self.log(configtopic + ":" + json.dumps(message))
-        client.publish(configtopic,json.dumps(message), retain=True)
+        payload = self.discovery_json(message)
+        if log_mqtt_discovery:
+            self.log(configtopic + ":" + payload)
+        self.pendingDiscovery.append((configtopic, payload))
         return area
 
+    # Overload get_site_data to publish all the discovery messages in one go
+    # once enumeration is finished, rather than one at a time in between
+    # panel round-trips
+    def get_site_data(self):
+        # the panel may have changed since the site data was last read
+        self.deviceJson = None
+        self.pendingDiscovery = []
+        ok = super(TexecomConnectMqtt, self).get_site_data()
+        self.flush_discovery()
+        return ok
+
+    def flush_discovery(self):
+        for configtopic, payload in self.pendingDiscovery:
+            client.publish(configtopic, payload, 0, True)  # qos 0, retained
+        self.pendingDiscovery = []
+
 
 def message_handler(payload):
     tc.log(tc.decode_message_to_text(payload))
@@ -109,42 +168,37 @@ def message_handler(payload):
         zone_number = ord(payload[0])
         zone_bitmap = ord(payload[1])
         zone = tc.get_zone(zone_number)
-        zone.state = zone_bitmap & 0x3
-        topic = "homeassistant/binary_sensor/"+str.lower((zone.text).replace(" ", "_"))+"/state"
-        if zone.state == 1:
-            zone.active = True
-        else:
-            zone.active = False
+        zone.save_state(zone_bitmap)
+        # state topic is normally cached by get_zone_details; only build it
+        # here for zones the panel didn't tell us about during enumeration
+        if not hasattr(zone, "state_topic"):
+            zone.state_topic = BINARY_SENSOR_TOPIC + zone.text.translate(HA_NAME_TABLE) + "/state"
+        topic = zone.state_topic
         tc.log("MQTT Update %s: %s" % (topic, zone.state))
         client.publish(topic,zone.state)
     elif msg_type == tc.MSG_AREAEVENT:
         area_number = ord(payload[0])
         area_state = ord(payload[1])
-        area_state_str = ["disarmed", "pending", "pending", "armed_away", "armed_night", "triggered"][area_state]
+        area_state_str = HA_AREA_STATES[area_state]
         area = tc.get_area(area_number)
         area.state = area_state_str
-        topic = "homeassistant/alarm_control_panel/" + str.lower((area.name).replace(" ", "_"))+"/state"
+        if not hasattr(area, "state_topic"):
+            area.state_topic = ALARM_PANEL_TOPIC + area.name.translate(HA_NAME_TABLE) + "/state"
+        topic = area.state_topic
         tc.log("MQTT Update %s: %s" % (topic, area.state))
         client.publish(topic, area.state)
 
 
-# disable buffering to stdout when it's redirected to a file/pipe
+# line buffer stdout even when it's redirected to a file/pipe
 # This makes sure any events appear immediately in the file/pipe,
-# instead of being queued until there is a full buffer's worth.
-class Unbuffered(object):
-    def __init__(self, stream):
-        self.stream = stream
-
-    def write(self, data):
-        self.stream.write(data)
-        self.stream.flush()
-
-    def writelines(self, datas):
-        self.stream.writelines(datas)
-        self.stream.flush()
-
-    def __getattr__(self, attr):
-        return getattr(self.stream, attr)
+# instead of being queued until there is a full buffer's worth, without
+# paying for a flush on every individual write.
+def line_buffer_stdout():
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(line_buffering=True)
+    else:
+        # python 2
+        sys.stdout = os.fdopen(sys.stdout.fileno(), "w", 1)
 
 if __name__ == '__main__':
     texhost = os.getenv('TEXHOST','192.168.1.9')
@@ -154,6 +208,6 @@ if __name__ == '__main__':
     # random 16 character alphanumeric string.
     udlpassword = os.getenv('UDLPASSWORD','1234')
 
-    sys.stdout = Unbuffered(sys.stdout)
+    line_buffer_stdout()
     tc = TexecomConnectMqtt(texhost, texport, udlpassword, message_handler)
     tc.event_loop()
@@ -26,10 +26,109 @@ import datetime
 import os
 import sys
 import re
+import struct
+import subprocess
+import threading
+import atexit
+
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
 
-import crcmod
 import hexdump
 
+# Log lines are handed to a background thread to write out, so a slow
+# terminal or a full pipe on stdout doesn't stall the event loop. The
+# thread is only started when something is first logged.
+log_queue = queue.Queue()
+log_writer_thread = None
+log_writer_lock = threading.Lock()
+
+def log_writer():
+    """Write (timestamp, string) entries from log_queue to stdout until
+    a None entry arrives"""
+    while True:
+        entry = log_queue.get()
+        if entry is None:
+            return
+        timestamp, string = entry
+        print(time.strftime("%Y-%m-%d %X", time.localtime(timestamp)) + ": " + string)
+
+def start_log_writer():
+    """Start the log writer thread, unless it is already running"""
+    global log_writer_thread
+    with log_writer_lock:
+        if log_writer_thread is None:
+            thread = threading.Thread(target=log_writer, name="log-writer")
+            thread.daemon = True
+            thread.start()
+            atexit.register(stop_log_writer, thread)
+            log_writer_thread = thread
+
+def stop_log_writer(thread):
+    """Let the log writer finish anything still queued before exiting"""
+    log_queue.put(None)
+    thread.join(5)
+
+def log(string):
+    """Log a line with the current time; the time is taken now, but only
+    formatted when the line is written"""
+    if log_writer_thread is None:
+        start_log_writer()
+    log_queue.put((time.time(), string))
+
+# Runs of non-word characters (including the NUL padding) in names read from the panel
+NON_WORD_RE = re.compile(r'\W+')
+
+# Log event timestamps are a little endian 32 bit packed date/time
+UINT32_LE = struct.Struct("<I")
+
+# Log event group type suffixes for the comm delayed (bit 6) and
+# communicated (bit 7) flags, indexed by those two bits
+COMM_SUFFIX = ("", " [comm delayed]", " [communicated]", " [comm delayed] [communicated]")
+
+# The digits encoded by each possible BCD byte; nibbles above 9 are padding
+BCD_DIGITS = tuple("".join(str(val) for val in (byte >> 4, byte & 0xF) if val <= 9)
+                   for byte in range(256))
+
+# Clock for timeouts, which shouldn't jump if the wall clock is changed;
+# python 2 doesn't have one so falls back to the wall clock
+monotonic = getattr(time, "monotonic", time.time)
+
+# Two digit hex text for each possible byte, for logging payloads
+HEX_BYTES = tuple("%02x" % byte for byte in range(256))
+
+def make_crc8_table(poly):
+    """Build the 256 entry lookup table for a non-reflected CRC-8"""
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ poly) & 0xff
+            else:
+                crc = (crc << 1) & 0xff
+        table[i] = crc
+    return table
+
+# The panel uses CRC-8 with polynomial x^8 + x^7 + x^2 + 1, initial value 0xff
+CRC8_TABLE = make_crc8_table(0x85)
+
+def crc8(data, table=CRC8_TABLE):
+    """Calculate the CRC of a message, one table lookup per byte
+
+    The table is bound as a default argument so the loop uses a fast
+    local lookup rather than a global one. A bytearray is scanned as is;
+    anything else is copied into one first."""
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    crc = 0xff
+    for byte in data:
+        crc = table[crc ^ byte]
+    return crc
+
 class User(object):
     def __init__(self):
         self.passcode = None
@@ -40,13 +139,41 @@ class User(object):
 
 
 class Area(object):
-    def __init__(self):
+    STATE_TEXT = ("disarmed", "in exit", "in entry", "armed", "part armed", "in alarm")
+
+    def __init__(self, area_number):
+        self.number = area_number
         self.name = "unknown"
         self.state = "unknown"
 
+def lookup_table(names, size, unknown_format):
+    """Turn a dict of names keyed by small integers into a tuple indexed by
+    them, with any gaps filled in from unknown_format"""
+    return tuple(names.get(i, unknown_format.format(i)) for i in range(size))
+
+def zone_state_text(zone_bitmap):
+    """Describe the zone state bitmap from a zone event"""
+    zone_str = ["secure", "active", "tamper", "short"][zone_bitmap & 0x3]
+    if zone_bitmap & (1 << 2):
+        zone_str += ", fault"
+    if zone_bitmap & (1 << 3):
+        zone_str += ", failed test"
+    if zone_bitmap & (1 << 4):
+        zone_str += ", alarmed"
+    if zone_bitmap & (1 << 5):
+        zone_str += ", manual bypassed"
+    if zone_bitmap & (1 << 6):
+        zone_str += ", auto bypassed"
+    if zone_bitmap & (1 << 7):
+        zone_str += ", zone masked"
+    return zone_str
+
 class Zone(object):
     """Information about a zone and it's current state
     """
+    # the bitmap is a single byte, so describe every possible value up front
+    STATE_TEXT = tuple(zone_state_text(zone_bitmap) for zone_bitmap in range(256))
+
     def __init__(self, zone_number):
         self.number = zone_number
         self.text = ""
@@ -59,9 +186,18 @@ class Zone(object):
         self.smoothed_active_func = None
         self.smoothed_active_since = None
         self.smoothed_last_active = None
+        self.state = None
         pass
 
+    def save_state(self, zone_bitmap):
+        """Record the state bitmap from a zone event message"""
+        self.state = zone_bitmap & 0x3
+        self.active = self.state == 1
+
     def update(self):
+        if not self.__active and not self.__smoothed_active:
+            # nothing to do for an idle zone, which is most of them most of the time
+            return
         if self.smoothed_active and not self.active:
             time_since_last_active = time.time() - self.last_active
             if time_since_last_active > self.smoothed_active_delay:
@@ -115,6 +251,11 @@ class TexecomConnect(object):
     HEADER_TYPE_COMMAND = 'C'
     HEADER_TYPE_RESPONSE = 'R'
     HEADER_TYPE_MESSAGE = 'M'  # unsolicited message
+    # the same as byte values, for checking received headers
+    HEADER_START_I = ord(HEADER_START)
+    HEADER_TYPE_COMMAND_I = ord(HEADER_TYPE_COMMAND)
+    HEADER_TYPE_RESPONSE_I = ord(HEADER_TYPE_RESPONSE)
+    HEADER_TYPE_MESSAGE_I = ord(HEADER_TYPE_MESSAGE)
 
     CMD_LOGIN = chr(1)
     CMD_GETZONEDETAILS = chr(3)
@@ -135,6 +276,15 @@ class TexecomConnect(object):
     CMD_TIMEOUT = 2
     CMD_RETRIES = 3
 
+    # size of our receive buffer; one read will often pick up several
+    # messages when the panel sends a burst of events
+    RECV_SIZE = 4096
+    # kernel receive buffer for the panel socket, big enough to absorb a
+    # burst of event messages (e.g. when an alarm is triggered)
+    SOCKET_RECV_BUFFER = 65536
+    # TCP keepalive: start probing after 60s idle, every 10s, give up after 3
+    SOCKET_KEEPALIVE = (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3))
+
     ZONETYPE_UNUSED = 0
 
     CMD_RESPONSE_ACK = '\x06'
@@ -147,6 +297,20 @@ class TexecomConnect(object):
     MSG_USEREVENT = chr(4)
     MSG_LOGEVENT = chr(5)
 
+    # which event messages CMD_SETEVENTMESSAGES asks the panel to send us
+    DEBUG_FLAG = 1
+    ZONE_EVENT_FLAG = 1 << 1
+    AREA_EVENT_FLAG = 1 << 2
+    OUTPUT_EVENT_FLAG = 1 << 3
+    USER_EVENT_FLAG = 1 << 4
+    LOG_FLAG = 1 << 5
+    EVENT_MESSAGES_BODY = struct.pack("<H",
+        ZONE_EVENT_FLAG | AREA_EVENT_FLAG | OUTPUT_EVENT_FLAG | USER_EVENT_FLAG | LOG_FLAG)
+
+    # log events after which the zone/area/user names etc may have changed:
+    # Download End, Installer Programming End, Site Data Changed
+    SITE_DATA_CHANGED_LOG_EVENTS = (54, 59, 100)
+
     zone_types = {}
     zone_types[1] = "Entry/Exit 1"
     zone_types[2] = "Entry/Exit 2"
@@ -332,11 +496,14 @@ class TexecomConnect(object):
     log_event_group_type[34] = "PA Timer Reset"
     log_event_group_type[35] = "PA Zone Lockout"
 
+    # The same names as tuples indexed directly by the (byte sized) values in log events
+    log_event_types_table = lookup_table(log_event_types, 256, "Unknown log event type {:d}")
+    log_event_group_type_table = lookup_table(log_event_group_type, 64, "Unknown log event group type {:d}")
+
     def __init__(self, host, port, udl_password, message_handler_func):
         self.host = host
         self.port = port
         self.udlpassword = udl_password
-        self.crc8_func = crcmod.mkCrcFun(poly=0x185, rev=False, initCrc=0xff)
         self.nextseq = 0
         self.message_handler_func = message_handler_func
         self.print_network_traffic = False
@@ -347,23 +514,51 @@ class TexecomConnect(object):
         self.panelType = None
         self.firmwareVersion = None
         self.numberOfZones = -1
+        # encodes zone/user numbers in commands; set for the panel by get_number_zones
+        self.zoneNumberStruct = struct.Struct("<B")
         self.zone = {}
+        # snapshot of self.zone.values() for the idle loop; reset to None whenever a zone is added
+        self.zoneList = None
         self.user = {}
         self.area = {}
         self.s = None
+        # data received from the panel; rxbuf[rxstart:rxend] hasn't been processed yet
+        self.rxbuf = bytearray(self.RECV_SIZE)
+        self.rxview = memoryview(self.rxbuf)
+        self.rxstart = 0
+        self.rxend = 0
         # used to record which of our idle commands we last sent to the panel
         self.lastIdleCommand = 0
         # Set to true if the idle loop should reread the site data
         self.siteDataChanged = False
+        # (panelType, numberOfZones, firmwareVersion) of the panel the current
+        # areas/zones/users were read from, so they can be reused on reconnect
+        self.siteDataPanel = None
+
+    @staticmethod
+    def clean_text(text):
+        """Tidy up a name read from the panel - NUL padding and any other
+        runs of non-word characters become a single space"""
+        return NON_WORD_RE.sub(' ', text).strip()
 
     @staticmethod
     def hexstr(s):
         """Convert a binary string into a hex representation suitable for logging payloads etc"""
-        return " ".join("{:02x}".format(ord(c)) for c in s)
+        return " ".join(map(HEX_BYTES.__getitem__, bytearray(s)))
 
     def connect(self):
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.settimeout(self.CMD_TIMEOUT)
+        # commands are tiny and we always wait for the reply, so don't let
+        # Nagle's algorithm hold them back waiting for a delayed ACK
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_RECV_BUFFER)
+        # notice a panel (or network) that has silently gone away; the default
+        # keepalive idle time is hours, so shorten it where the OS lets us
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in self.SOCKET_KEEPALIVE:
+            if hasattr(socket, option):
+                self.s.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
         self.s.connect((self.host, self.port))
         # if we send the login message to fast the panel ignores it; texecom
         # recommend 500ms, see:
@@ -371,10 +566,8 @@ class TexecomConnect(object):
         time.sleep(0.5)
 
     def getnextseq(self):
-        if self.nextseq == 256:
-            self.nextseq = 0
         nextseq = self.nextseq
-        self.nextseq += 1
+        self.nextseq = (nextseq + 1) & 0xff
         return nextseq
 
     def closesocket(self):
@@ -385,17 +578,44 @@ class TexecomConnect(object):
                 pass
             self.s.close()
             self.s = None
+        self.rxstart = 0
+        self.rxend = 0
+
+    def fillrxbuf(self, length):
+        """Wait until at least length unprocessed bytes are buffered, reading
+        from the socket straight into rxbuf. Returns False if the panel
+        closes the connection first. If the socket times out, whatever has
+        arrived so far stays buffered for next time"""
+        while self.rxend - self.rxstart < length:
+            if self.rxstart > 0:
+                # move the unprocessed data to the start of the buffer to make room
+                pending = self.rxend - self.rxstart
+                self.rxbuf[:pending] = self.rxbuf[self.rxstart:self.rxend]
+                self.rxstart = 0
+                self.rxend = pending
+            count = self.s.recv_into(self.rxview[self.rxend:])
+            if count == 0:
+                return False
+            self.rxend += count
+        return True
+
+    def recvbytes(self, length):
+        """Take up to length bytes from the receive buffer"""
+        end = min(self.rxstart + max(length, 0), self.rxend)
+        data = bytes(self.rxbuf[self.rxstart:end])
+        self.rxstart = end
+        return data
 
     def recvresponse(self):
         """Receive a response to a command. Automatically handles any
         messages that arrive first"""
-        startTime = time.time()
+        startTime = monotonic()
         while True:
-            if time.time() - startTime > self.CMD_TIMEOUT:
+            now = monotonic()
+            if now - startTime > self.CMD_TIMEOUT:
                 # if we have had multiple event messages, we may get to the timeout time without the recv timing out
                 raise socket.timeout
-            assert self.last_command_time > 0
-            time_since_last_command = time.time() - self.last_command_time
+            time_since_last_command = now - self.last_command_time
             if time_since_last_command > 30:
                 # send any message to reset the panel's 60 second timeout
                 # this ends up recursively calling recvresponse; however as our retry * timeout (3 * 2 == 6) is
@@ -413,10 +633,16 @@ class TexecomConnect(object):
                     self.log("idle command failed; closing socket")
                     self.closesocket()
                     return None
-            header = self.s.recv(self.LENGTH_HEADER)
+            if self.fillrxbuf(1) and self.rxbuf[self.rxstart] == self.HEADER_START_I:
+                # wait for the whole message before taking any of it, so if
+                # it is split across reads and we time out part way through
+                # we'll pick up from the start of the message next time.
+                # Anything else (e.g. a "+++" hangup) is taken as it arrives.
+                if self.fillrxbuf(self.LENGTH_HEADER):
+                    self.fillrxbuf(self.rxbuf[self.rxstart + 2])
+            header = self.recvbytes(self.LENGTH_HEADER)
             if self.print_network_traffic:
-                self.log("Received message header:")
-                hexdump.hexdump(header)
+                self.log("Received message header:\n" + hexdump.hexdump(header, result="return"))
             if header == "+++":
                 self.log("Panel has forcibly dropped connection, possibly due to inactivity")
                 self.closesocket()
@@ -432,71 +658,71 @@ class TexecomConnect(object):
             if len(header) < self.LENGTH_HEADER:
                 self.log("Header received from panel is too short, only {:d} bytes, ignoring - contents {}".format(
                     len(header), self.hexstr(header)))
-                hexdump.hexdump(header)
                 continue
-            msg_start, msg_type, msg_length, msg_sequence = list(header)
-            if msg_start != 't':
-                self.log("unexpected msg start: " + hex(ord(msg_start)))
-                hexdump.hexdump(header)
+            msg_start, msg_type, msg_length, msg_sequence = bytearray(header)
+            if msg_start != self.HEADER_START_I:
+                self.log("unexpected msg start: " + hex(msg_start) + " - header " + self.hexstr(header))
+                return None
+            if msg_length < self.LENGTH_HEADER + 1:
+                # too short to even hold the crc
+                self.log("invalid msg length: " + str(msg_length) + " - header " + self.hexstr(header))
                 return None
-            expected_len = ord(msg_length) - self.LENGTH_HEADER
-            payload = self.s.recv(expected_len)
+            expected_len = msg_length - self.LENGTH_HEADER
+            payload = self.recvbytes(expected_len)
             if self.print_network_traffic:
-                self.log("Received message payload:")
-                hexdump.hexdump(payload)
+                self.log("Received message payload:\n" + hexdump.hexdump(payload, result="return"))
             if len(payload) < expected_len:
                 self.log(
-                    "Ignoring message, payload shorter than expected - got {:d} bytes, expected {:d} - contents {}".format(
-                        len(payload), expected_len, self.hexstr(payload)))
-                print("header:")
-                hexdump.hexdump(header)
-                print("payload:")
-                hexdump.hexdump(payload)
+                    "Ignoring message, payload shorter than expected - got {:d} bytes, expected {:d} - header {} contents {}".format(
+                        len(payload), expected_len, self.hexstr(header), self.hexstr(payload)))
                 continue
             payload, msg_crc = payload[:-1], ord(payload[-1])
-            expected_crc = self.crc8_func(header + payload)
+            # the whole message is still sitting in the receive buffer just
+            # behind rxstart, so check the crc over a single copy of it
+            expected_crc = crc8(self.rxbuf[self.rxstart - msg_length:self.rxstart - 1])
             if msg_crc != expected_crc:
                 self.log("crc: expected=" + str(expected_crc) + " actual=" + str(msg_crc))
                 return None
-            if msg_type == self.HEADER_TYPE_RESPONSE:
+            if msg_type == self.HEADER_TYPE_RESPONSE_I:
                 if msg_sequence != self.last_sequence:
                     self.log(
-                        "incorrect response seq: expected=" + str(self.last_sequence) + " actual=" + str(ord(msg_sequence)))
+                        "incorrect response seq: expected=" + str(self.last_sequence) + " actual=" + str(msg_sequence))
                     # recv again - either we receive the correct reply in the next packet, or we'll time out and retry the command
                     continue
-            elif msg_type == self.HEADER_TYPE_MESSAGE:
+            elif msg_type == self.HEADER_TYPE_MESSAGE_I:
                 if self.last_received_seq != -1:
-                    next_msg_seq = self.last_received_seq + 1
-                    if next_msg_seq == 256:
-                        next_msg_seq = 0
-                    if msg_sequence == chr(self.last_received_seq):
+                    next_msg_seq = (self.last_received_seq + 1) & 0xff
+                    if msg_sequence == self.last_received_seq:
                         self.log("ignoring message, sequence number is the same as last message: expected=" + str(
-                            next_msg_seq) + " actual=" + str(ord(msg_sequence)))
+                            next_msg_seq) + " actual=" + str(msg_sequence))
                         continue
-                    if msg_sequence != chr(next_msg_seq):
+                    if msg_sequence != next_msg_seq:
                         self.log("message seq incorrect - processing message anyway: expected=" + str(
-                            next_msg_seq) + " actual=" + str(ord(msg_sequence)))
+                            next_msg_seq) + " actual=" + str(msg_sequence))
                         # process message anyway; perhaps we missed one or they arrived out of order
-                self.last_received_seq = ord(msg_sequence)
-            if msg_type == self.HEADER_TYPE_COMMAND:
+                self.last_received_seq = msg_sequence
+            if msg_type == self.HEADER_TYPE_COMMAND_I:
                 self.log("received command unexpectedly")
                 return None
-            elif msg_type == self.HEADER_TYPE_RESPONSE:
+            elif msg_type == self.HEADER_TYPE_RESPONSE_I:
                 return payload
-            elif msg_type == self.HEADER_TYPE_MESSAGE:
-                # FIXME: for "Site Data Changed" we should re-read the zone names etc - need to decode message
-                # self.siteDataChanged = True
+            elif msg_type == self.HEADER_TYPE_MESSAGE_I:
+                if payload[0] == self.MSG_LOGEVENT and len(payload) > 1 and \
+                        ord(payload[1]) in self.SITE_DATA_CHANGED_LOG_EVENTS:
+                    self.siteDataChanged = True
                 self.message_handler_func(payload)
 
     def sendcommandbody(self, body):
-        self.last_sequence = chr(self.getnextseq())
-        data = self.HEADER_START + self.HEADER_TYPE_COMMAND + \
-               chr(len(body) + 5) + self.last_sequence + body
-        data += chr(self.crc8_func(data))
+        seq = self.last_sequence = self.getnextseq()
+        # build the frame up in place; the crc is calculated over the same buffer
+        data = bytearray(self.HEADER_START + self.HEADER_TYPE_COMMAND)
+        data.append(len(body) + 5)
+        data.append(seq)
+        data += body
+        data.append(crc8(data))
         if self.print_network_traffic:
-            self.log("Sending command:")
-            hexdump.hexdump(data)
-        self.s.send(data)
+            self.log("Sending command:\n" + hexdump.hexdump(bytes(data), result="return"))
+        self.s.sendall(data)
         self.last_command = data
 
     def login(self):
@@ -513,15 +739,7 @@ class TexecomConnect(object):
         return True
 
     def set_event_messages(self):
-        DEBUG_FLAG = 1
-        ZONE_EVENT_FLAG = 1 << 1
-        AREA_EVENT_FLAG = 1 << 2
-        OUTPUT_EVENT_FLAG = 1 << 3
-        USER_EVENT_FLAG = 1 << 4
-        LOG_FLAG = 1 << 5
-        events = ZONE_EVENT_FLAG | AREA_EVENT_FLAG | OUTPUT_EVENT_FLAG | USER_EVENT_FLAG | LOG_FLAG
-        body = chr(events & 0xff) + chr(events >> 8)
-        response = self.sendcommand(self.CMD_SETEVENTMESSAGES, body)
+        response = self.sendcommand(self.CMD_SETEVENTMESSAGES, self.EVENT_MESSAGES_BODY)
         if response == self.CMD_RESPONSE_NAK:
             self.log("NAK response from panel")
             return False
@@ -532,8 +750,7 @@ class TexecomConnect(object):
 
     @staticmethod
     def log(string):
-        timestamp = time.strftime("%Y-%m-%d %X")
-        print(timestamp + ": " + string)
+        log(string)
 
     def sendcommand(self, cmd, body):
         if body is not None:
@@ -541,7 +758,7 @@ class TexecomConnect(object):
         else:
             body = cmd
         self.sendcommandbody(body)
-        self.last_command_time = time.time()
+        self.last_command_time = monotonic()
         retries = self.CMD_RETRIES
         response = None
         while retries > 0:
@@ -552,8 +769,8 @@ class TexecomConnect(object):
             except socket.timeout:
                 self.log("Timeout waiting for response, resending last command")
                 # NB: sequence number will be the same as last attempt
-                self.last_command_time = time.time()
-                self.s.send(self.last_command)
+                self.last_command_time = monotonic()
+                self.s.sendall(self.last_command)
 
         self.last_command = None
         if response is None:
@@ -577,9 +794,9 @@ class TexecomConnect(object):
             self.log("GETDATETIME: response too short")
             self.log("Payload: " + self.hexstr(datetimeresp))
             return None
-        datetimeresp = bytearray(datetimeresp)
-        datetimestr = '20{2:02d}-{1:02d}-{0:02d} {3:02d}:{4:02d}:{5:02d}'.format(*datetimeresp)
-        paneltime = datetime.datetime(2000 + datetimeresp[2], datetimeresp[1], datetimeresp[0], *datetimeresp[3:])
+        day, month, year, hour, minute, second = struct.unpack_from("6B", datetimeresp)
+        datetimestr = '20{:02d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(year, month, day, hour, minute, second)
+        paneltime = datetime.datetime(2000 + year, month, day, hour, minute, second)
         seconds = int((paneltime - datetime.datetime.now()).total_seconds())
         if seconds > 0:
             diff = " (panel is ahead by {:d} seconds)".format(seconds)
@@ -607,7 +824,7 @@ class TexecomConnect(object):
             self.log("GETLOGPOINTER: response wrong length")
             self.log("Payload: " + self.hexstr(logpointerresp))
             return None
-        logpointer = ord(logpointerresp[0]) + (ord(logpointerresp[1]) << 8)
+        logpointer = struct.unpack("<H", logpointerresp)[0]
         self.log("Log pointer: {:d}".format(logpointer))
         return logpointer
 
@@ -617,6 +834,11 @@ class TexecomConnect(object):
             return None
         self.panelType, numberOfZones, something, self.firmwareVersion = idstr.split()
         self.numberOfZones = int(numberOfZones)
+        # zone and user numbers are two bytes on panels with more than 255 zones
+        if self.numberOfZones > 255:
+            self.zoneNumberStruct = struct.Struct("<H")
+        else:
+            self.zoneNumberStruct = struct.Struct("<B")
 
     def get_panel_identification(self):
         panelid = self.sendcommand(self.CMD_GETPANELIDENTIFICATION, None)
@@ -630,13 +852,14 @@ class TexecomConnect(object):
         return panelid
 
     def get_zone(self, zone_number):
-        if zone_number not in self.zone:
-            self.zone[zone_number] = Zone(zone_number)
-        return self.zone[zone_number]
+        zone = self.zone.get(zone_number)
+        if zone is None:
+            zone = self.zone[zone_number] = Zone(zone_number)
+            self.zoneList = None
+        return zone
 
     def get_zone_details(self, zone_number):
-        # zone is two bytes on 680
-        details = self.sendcommand(self.CMD_GETZONEDETAILS, chr(zone_number))
+        details = self.sendcommand(self.CMD_GETZONEDETAILS, self.zoneNumberStruct.pack(zone_number))
         if details is None:
             return None
         zone = self.get_zone(zone_number)
@@ -646,49 +869,39 @@ class TexecomConnect(object):
             zone.text = details[2:]
         elif len(details) == 35:
             zone.zoneType = ord(details[0])
-            zone.areaBitmap = ord(details[1]) + (ord(details[2]) << 8)
+            zone.areaBitmap = struct.unpack_from("<H", details, 1)[0]
             zone.text = details[3:]
         elif len(details) == 41:
             zone.zoneType = ord(details[0])
-            zone.areaBitmap = ord(details[1]) + (ord(details[2]) << 8) + (ord(details[3]) << 16) + (
-                        ord(details[4]) << 24) + \
-                              (ord(details[5]) << 32) + (ord(details[6]) << 40) + (ord(details[7]) << 48) + (
-                                          ord(details[8]) << 56)
+            zone.areaBitmap = struct.unpack_from("<Q", details, 1)[0]
             zone.text = details[9:]
         else:
             self.log("GETZONEDETAILS: response wrong length")
             self.log("Payload: " + self.hexstr(details))
             return None
 
-        zone.text = zone.text.replace("\x00", " ")
-        zone.text = re.sub(r'\W+', ' ', zone.text)
-        zone.text = zone.text.strip()
+        zone.text = self.clean_text(zone.text)
         if zone.zoneType != self.ZONETYPE_UNUSED:
             self.log("zone {:d} type {} name '{}'".
                      format(zone.number, self.zone_types[zone.zoneType], zone.text))
         return zone
 
     def get_area(self, areaNumber):
-        if areaNumber not in self.zone:
-            self.area[areaNumber] = Area(areaNumber)
-        return self.area[areaNumber]
+        area = self.area.get(areaNumber)
+        if area is None:
+            area = self.area[areaNumber] = Area(areaNumber)
+        return area
 
     def get_area_details(self, areaNumber):
         details = self.sendcommand(self.CMD_GETAREADETAILS, chr(areaNumber))
         if details is None:
             return None
-        area = Area()
+        area = self.get_area(areaNumber)
         if len(details) == 25:
             # first byte is area number
-            areatext = details[1:17]
-            areatext = areatext.replace("\x00", " ")
-            areatext = re.sub(r'\W+', ' ', areatext)
-            areatext = areatext.strip()
-            area.name = areatext
-            area.exitDelay = ord(details[17]) + (ord(details[18]) << 8)
-            area.entry1Delay = ord(details[19]) + (ord(details[20]) << 8)
-            area.entry2Delay = ord(details[21]) + (ord(details[22]) << 8)
-            area.secondEntry = ord(details[23]) + (ord(details[24]) << 8)
+            area.name = self.clean_text(details[1:17])
+            area.exitDelay, area.entry1Delay, area.entry2Delay, area.secondEntry = \
+                struct.unpack_from("<HHHH", details, 17)
         else:
             self.log("GETAREADETAILS: response wrong length")
             self.log("Payload: " + self.hexstr(details))
@@ -699,34 +912,23 @@ class TexecomConnect(object):
 
     @staticmethod
     def bcdDecode(bcd):
-        result = ""
-        for char in bcd:
-            for val in (ord(char) >> 4, ord(char) & 0xF):
-                if val <= 9:
-                    result += str(val)
-        return result
+        return "".join(BCD_DIGITS[byte] for byte in bytearray(bcd))
 
     def get_user(self, usernumber):
-        # panel may support more than 255 users, in which case this needs 2 bytes
-        # body = chr(usernumber & 0xff)+chr(usernumber >> 8)
-        body = chr(usernumber)
+        body = self.zoneNumberStruct.pack(usernumber)
         details = self.sendcommand(self.CMD_GETUSER, body)
         if details is None:
             return None
         user = User()
         if len(details) == 23:
-            username = details[0:8]
-            username = username.replace("\x00", " ")
-            username = re.sub(r'\W+', ' ', username)
-            username = username.strip()
-            user.name = username
+            user.name = self.clean_text(details[0:8])
             user.passcode = self.bcdDecode(details[8:11])
             user.areas = ord(details[11])
             user.modifiers = details[12]
             user.locks = details[13]
             user.doors = details[14:17]
             user.tag = self.bcdDecode(details[17:21])  # last byte always 0xff
-            user.config = ord(details[21]) + (ord(details[22]) << 8)
+            user.config = struct.unpack_from("<H", details, 21)[0]
         else:
             # there are other lengths but I have no way to test
             self.log("GETUSER: unexpected response length {:d}".format(len(details)))
@@ -763,30 +965,57 @@ class TexecomConnect(object):
         return (system_voltage, battery_voltage, system_current, battery_current)
 
     def get_all_zones(self):
+        """Read every zone's details; returns False if any couldn't be read"""
+        ok = True
         for zoneNumber in range(1, self.numberOfZones + 1):
-            zone = self.get_zone_details(zoneNumber)
-            self.zone[zoneNumber] = zone
+            # get_zone_details updates the Zone already held in self.zone
+            if self.get_zone_details(zoneNumber) is None:
+                ok = False
+        return ok
 
     def get_all_users(self):
+        """Read every user's details; returns False if any couldn't be read"""
+        ok = True
         panel_users = {12: 8, 24: 25, 48: 50, 64: 50, 88: 100, 168: 200, 640: 1000}
+        get_user = self.get_user
+        users = self.user
         for usernumber in range(1, panel_users[self.numberOfZones]):
-            user = self.get_user(usernumber)
-            if user.valid():
-                self.user[usernumber] = user
+            user = get_user(usernumber)
+            # None means the panel didn't give us a usable response
+            if user is None:
+                ok = False
+            elif user.valid():
+                users[usernumber] = user
         user = User()
         user.name = "Engineer"
         self.user[0] = user
+        return ok
 
     def get_all_areas(self):
+        """Read every area's details; returns False if any couldn't be read"""
+        ok = True
         panel_areas = {12: 2, 24: 2, 48: 4, 64: 4, 88: 8, 168: 16, 640: 64}
         for areanumber in range(1, panel_areas[self.numberOfZones]):
-            area = self.get_area_details(areanumber)
-            self.area[areanumber] = area
+            # get_area_details updates the Area already held in self.area
+            if self.get_area_details(areanumber) is None:
+                ok = False
+        return ok
 
     def get_site_data(self):
-        self.get_all_areas()
-        self.get_all_zones()
-        self.get_all_users()
+        """Read all the areas, zones and users from the panel. Returns
+        True only if every one of them was read successfully"""
+        areas_ok = self.get_all_areas()
+        zones_ok = self.get_all_zones()
+        users_ok = self.get_all_users()
+        return areas_ok and zones_ok and users_ok
+
+    def send_message(self, message):
+        """Run send-message.sh to notify the user, without waiting for it to
+        finish so the event loop isn't held up"""
+        try:
+            subprocess.Popen(["./send-message.sh", message])
+        except OSError as e:
+            self.log("Running send-message.sh failed - {}".format(e))
 
     def event_loop(self):
         lastConnectedAt = time.time()
@@ -801,8 +1030,12 @@ class TexecomConnect(object):
             connectionLostTime = time.time() - lastConnectedAt
             if connectionLostTime >= 60 and not notifiedConnectionLoss:
                 self.log("Connection lost for over 60 seconds - calling send-message.sh")
-                os.system("./send-message.sh 'connection lost'")
+                self.send_message("connection lost")
                 notifiedConnectionLoss = True
+                # the panel may well have been reprogrammed (e.g. by Wintex,
+                # which needs our connection) while we were away, and we'd
+                # have missed the log events that tell us so
+                self.siteDataPanel = None
             try:
                 self.connect()
             except socket.error as e:
@@ -816,6 +1049,8 @@ class TexecomConnect(object):
                 self.closesocket()
                 continue
             self.log("login successful")
+            # recvresponse relies on this to decide when to send idle commands
+            assert self.last_command_time > 0
             if not self.set_event_messages():
                 self.log("Set event messages failed, closing socket")
                 self.closesocket()
@@ -823,21 +1058,37 @@ class TexecomConnect(object):
             connected = True
             if notifiedConnectionLoss:
                 self.log("Connection regained - calling send-message.sh")
-                os.system("./send-message.sh 'connection regained'")
+                self.send_message("connection regained")
             self.get_number_zones()
             self.get_date_time()
             self.get_system_power()
             self.get_log_pointer()
-            self.get_site_data()
-            self.log("Got all areas/zones/users; waiting for events")
+            panel = (self.panelType, self.numberOfZones, self.firmwareVersion)
+            if panel != self.siteDataPanel or self.siteDataChanged:
+                self.siteDataChanged = False
+                if self.get_site_data():
+                    self.siteDataPanel = panel
+                    self.log("Got all areas/zones/users; waiting for events")
+                else:
+                    # read everything again next time rather than keep the gaps
+                    self.siteDataPanel = None
+                    self.log("Failed to read some areas/zones/users; waiting for events")
+            else:
+                self.log("Same panel as last connection, reusing areas/zones/users; waiting for events")
+            # bound once here rather than looked up on self every pass
+            recvresponse = self.recvresponse
             while self.s is not None:
                 try:
-                    for zone in self.zone.values():
+                    zoneList = self.zoneList
+                    if zoneList is None:
+                        zoneList = self.zoneList = tuple(self.zone.values())
+                    for zone in zoneList:
                         zone.update()
                     if self.siteDataChanged:
                         self.siteDataChanged = False
-                        self.get_site_data()
-                    self.recvresponse()
+                        if not self.get_site_data():
+                            self.siteDataPanel = None
+                    recvresponse()
 
                 except socket.timeout:
                     # we didn't send any command, so a timeout is the expected result, continue our loop
@@ -852,24 +1103,11 @@ class TexecomConnect(object):
                 zone_number = ord(payload[0])
                 zone_bitmap = ord(payload[1])
             elif len(payload) == 3:
-                zone_number = ord(payload[0]) + (ord(payload[1]) << 8)
+                zone_number = struct.unpack_from("<H", payload)[0]
                 zone_bitmap = ord(payload[2])
             else:
                 return "unknown zone event message payload length"
-            zone_state = zone_bitmap & 0x3
-            zone_str = ["secure", "active", "tamper", "short"][zone_state]
-            if zone_bitmap & (1 << 2):
-                zone_str += ", fault"
-            if zone_bitmap & (1 << 3):
-                zone_str += ", failed test"
-            if zone_bitmap & (1 << 4):
-                zone_str += ", alarmed"
-            if zone_bitmap & (1 << 5):
-                zone_str += ", manual bypassed"
-            if zone_bitmap & (1 << 6):
-                zone_str += ", auto bypassed"
-            if zone_bitmap & (1 << 7):
-                zone_str += ", zone masked"
+            zone_str = Zone.STATE_TEXT[zone_bitmap]
             if zone_number in self.zone:
                 zone_text = self.zone[zone_number].text
             else:
@@ -879,7 +1117,7 @@ class TexecomConnect(object):
         elif msg_type == self.MSG_AREAEVENT:
             area_number = ord(payload[0])
             area_state = ord(payload[1])
-            area_state_str = ["disarmed", "in exit", "in entry", "armed", "part armed", "in alarm"][area_state]
+            area_state_str = Area.STATE_TEXT[area_state]
             if area_number in self.area:
                 areaname = self.area[area_number].name
             else:
@@ -922,56 +1160,39 @@ class TexecomConnect(object):
             if len(payload) == 8:
                 parameter = ord(payload[2])
                 areas = ord(payload[3])
-                timestamp = payload[4:8]
+                timestamp_offset = 4
             elif len(payload) == 9:
                 # Premier 168 - longer message as 16 bits of area info
                 parameter = ord(payload[2])
                 areas = ord(payload[3]) + (ord(payload[8]) << 8)
-                timestamp = payload[4:8]
+                timestamp_offset = 4
             elif len(payload) == 10:
                 # Premier 640
                 # I'm unsure if this is correct and I don't have a panel to test with
-                parameter = ord(payload[2]) + (ord(payload[3]) << 8)
-                areas = ord(payload[4]) + (ord(payload[5]) << 8)
-                timestamp = payload[6:10]
+                parameter, areas = struct.unpack_from("<HH", payload, 2)
+                timestamp_offset = 6
             else:
                 return "unknown log event message payload length"
 
             event_type = ord(payload[0])
             group_type_msg = ord(payload[1])
-            timestamp_int = ord(timestamp[0]) + (ord(timestamp[1]) << 8) + (ord(timestamp[2]) << 16) + (
-                        ord(timestamp[3]) << 24)
+            timestamp_int = UINT32_LE.unpack_from(payload, timestamp_offset)[0]
             seconds = timestamp_int & 63
             minutes = (timestamp_int >> 6) & 63
             month = (timestamp_int >> 12) & 15
             hours = (timestamp_int >> 16) & 31
             day = (timestamp_int >> 21) & 31
             year = 2000 + ((timestamp_int >> 26) & 63)
-            timestamp_str = "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(year, month, day, hours, minutes,
-                                                                               seconds)
+            timestamp_str = "%04d-%02d-%02d %02d:%02d:%02d" % (year, month, day, hours, minutes, seconds)
 
-            if event_type in self.log_event_types:
-                event_str = self.log_event_types[event_type]
-            else:
-                event_str = "Unknown log event type {:d}".format(event_type)
+            event_str = self.log_event_types_table[event_type]
 
             group_type = group_type_msg & 0b00111111
-            comm_delayed = group_type_msg & 0b01000000
-            communicated = group_type_msg & 0b10000000
-
-            if group_type in self.log_event_group_type:
-                group_type_str = self.log_event_group_type[group_type]
-            else:
-                group_type_str = "Unknown log event group type {:d}".format(group_type)
-
-            if comm_delayed:
-                group_type_str += " [comm delayed]"
-            if communicated:
-                group_type_str += " [communicated]"
+            group_type_str = self.log_event_group_type_table[group_type] + \
+                COMM_SUFFIX[(group_type_msg >> 6) & 3]
 
-            return "Log event message: {} {}, {}  parameter: {:d}   areas: {:d}".format(timestamp_str, event_str,
-                                                                                        group_type_str, parameter,
-                                                                                        areas)
+            return "Log event message: %s %s, %s  parameter: %d   areas: %d" % (timestamp_str, event_str,
+                                                                                  group_type_str, parameter, areas)
         else:
             return "unknown message type " + str(ord(msg_type)) + ": " + self.hexstr(payload)
 
@@ -982,29 +1203,18 @@ def message_handler(payload):
         zone_number = ord(payload[0])
         zone_bitmap = ord(payload[1])
         zone = tc.get_zone(zone_number)
-        zone.state = zone_bitmap & 0x3
-        if zone.state == 1:
-            zone.active = True
-        else:
-            zone.active = False
+        zone.save_state(zone_bitmap)
 
-# disable buffering to stdout when it's redirected to a file/pipe
+# line buffer stdout even when it's redirected to a file/pipe
 # This makes sure any events appear immediately in the file/pipe,
-# instead of being queued until there is a full buffer's worth.
-class Unbuffered(object):
-    def __init__(self, stream):
-        self.stream = stream
-
-    def write(self, data):
-        self.stream.write(data)
-        self.stream.flush()
-
-    def writelines(self, datas):
-        self.stream.writelines(datas)
-        self.stream.flush()
-
-    def __getattr__(self, attr):
-        return getattr(self.stream, attr)
+# instead of being queued until there is a full buffer's worth, without
+# paying for a flush on every individual write.
+def line_buffer_stdout():
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(line_buffering=True)
+    else:
+        # python 2
+        sys.stdout = os.fdopen(sys.stdout.fileno(), "w", 1)
 
 if __name__ == '__main__':
     texhost = os.getenv('TEXHOST','192.168.1.9')
@@ -1014,6 +1224,6 @@ if __name__ == '__main__':
     # random 16 character alphanumeric string.
     udlpassword = os.getenv('UDLPASSWORD','1234')
 
-    sys.stdout = Unbuffered(sys.stdout)
+    line_buffer_stdout()
     tc = TexecomConnect(texhost, texport, udlpassword, message_handler)
     tc.event_loop()